@@ -17,13 +17,30 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import logging as log
+import struct
 
 from typing import Any
-from construct import Const, Container, Int16ul
+from construct import Container
 
 from transport import Transport
 from proto import DbgMuxFrame
 
+# Frame header: Magic, Length, TxCount, RxCount, MsgType
+_HDR = struct.Struct('<2sHBBB')
+
+# Inner messages, which are always encoded the same way
+_CONST_MSGS = {
+    DbgMuxFrame.MsgType.Enquiry: b'',
+    DbgMuxFrame.MsgType.Ack: b'',
+}
+
+# Complete ACK frames, indexed by RxCount (built on demand)
+_ACK_FRAMES: dict = {}
+
+
+class DbgMuxFrameError(ValueError):
+    ''' Malformed frame received from the target '''
+
 
 class DbgMuxPeer:
     def __init__(self, io: Transport):
@@ -31,54 +48,131 @@ class DbgMuxPeer:
         self.rx_count: int = 0
         self.io = io
 
+        # Received data, processed up to _rxpos
+        self._rxbuf = bytearray()
+        self._rxpos: int = 0
+
+    def _read_at_least(self, length: int) -> None:
+        ''' Make sure that at least the given number of bytes is buffered '''
+        need: int = length - (len(self._rxbuf) - self._rxpos)
+        if need > 0:
+            # Drop the processed data only now, not after every frame
+            del self._rxbuf[:self._rxpos]
+            self._rxpos = 0
+            # Drain everything available at once, but not less than needed
+            self._rxbuf += self.io.read_exact(max(need, self.io.pending()))
+
+    def reset(self) -> None:
+        ''' Drop the received data, e.g. left over from a previous session '''
+        self._rxbuf.clear()
+        self._rxpos = 0
+
+    def _resync(self) -> None:
+        ''' Skip to the next (potential) frame in the receive buffer '''
+        # So that the next recv() does not fail on the same bytes again;
+        # a trailing 0x42 is kept, as it may be the first half of the magic
+        offset: int = self._rxbuf.find(b'\x42\x42', self._rxpos + 1)
+        self._rxpos = offset if offset > 0 else len(self._rxbuf) - 1
+
+    def rx_pending(self) -> bool:
+        ''' Check if there is received data not processed by recv() yet '''
+        return len(self._rxbuf) > self._rxpos or self.io.pending() > 0
+
+    @staticmethod
+    def _build_frame(tx_count: int, rx_count: int,
+                     msg_type: DbgMuxFrame.MsgType,
+                     msg_data: bytes) -> bytearray:
+        # There is a Checksum construct, but it requires all checksummed fields
+        # to be wrapped into an additional RawCopy construct.  This is ugly and
+        # inconvinient from the API point of view, so we calculate the FCS manually.
+        # Building the whole Frame just to strip the FCS is rather expensive, so
+        # the fixed-size header is packed directly:
+        size = _HDR.size + len(msg_data)
+        frame = bytearray(size + 2)  # + FCS
+        _HDR.pack_into(frame, 0, b'\x42\x42', len(msg_data) + 5,
+                       tx_count, rx_count, msg_type)
+        frame[_HDR.size:size] = msg_data
+        fcs = DbgMuxFrame.fcs_func(memoryview(frame)[:size])
+        struct.pack_into('<H', frame, size, fcs)
+        return frame
+
     def send(self, msg_type: DbgMuxFrame.MsgType, msg: Any = b'') -> None:
-        # Encode the inner message first
-        msg_data = DbgMuxFrame.Msg.build(msg, MsgType=msg_type)
+        # Encode the inner message first (unless it's constant)
+        msg_data = _CONST_MSGS.get(msg_type)
+        if msg_data is None:
+            msg_data = DbgMuxFrame.Msg.build(msg, MsgType=msg_type)
+        self.send_data(msg_type, msg_data)
 
-        c = Container({
-            'TxCount': (self.tx_count + 1) % 256,
-            'RxCount': self.rx_count % 256,
-            'MsgType': msg_type,
-            'MsgData': msg_data,
-            'FCS': 0  # Calculated below
-        })
+    def send_data(self, msg_type: DbgMuxFrame.MsgType, msg_data: bytes) -> None:
+        ''' Send an already encoded message '''
+        rx_count = self.rx_count  # always fits into a byte
 
         # ACK is a bit special
         if msg_type == DbgMuxFrame.MsgType.Ack:
-            c['TxCount'] = 0xf1
-
-        # There is a Checksum construct, but it requires all checksummed fields
-        # to be wrapped into an additional RawCopy construct.  This is ugly and
-        # inconvinient from the API point of view, so we calculate the FCS manually:
-        frame = DbgMuxFrame.Frame.build(c)[:-2]  # strip b'\x00\x00'
-        c['FCS'] = DbgMuxFrame.fcs_func(frame)
-
-        log.debug('Tx frame (Ns=%03u, Nr=%03u, fcs=0x%04x) %s %s',
-                  c['TxCount'], c['RxCount'], c['FCS'],
-                  c['MsgType'], c['MsgData'].hex())
-
-        self.io.write(frame + Int16ul.build(c['FCS']))
+            tx_count = 0xf1
+            # ACK frames only differ in RxCount, so each one is built once
+            frame = _ACK_FRAMES.get(rx_count)
+            if frame is None:
+                frame = bytes(self._build_frame(tx_count, rx_count, msg_type, b''))
+                _ACK_FRAMES[rx_count] = frame
+        else:
+            tx_count = (self.tx_count + 1) & 0xff
+            frame = self._build_frame(tx_count, rx_count, msg_type, msg_data)
+
+        if log.getLogger().isEnabledFor(log.DEBUG):  # avoid hex() otherwise
+            log.debug('Tx frame (Ns=%03u, Nr=%03u, fcs=0x%04x) %s %s',
+                      tx_count, rx_count, int.from_bytes(frame[-2:], 'little'),
+                      msg_type, frame[_HDR.size:-2].hex())
+
+        self.io.write(frame)
 
         # ACK is not getting accounted
         if msg_type != DbgMuxFrame.MsgType.Ack:
-            self.tx_count += 1
+            self.tx_count = tx_count
 
     def recv(self) -> Container:
-        frame: bytes = b''
-        frame += self.io.read(2)  # Magic
-        Const(b'\x42\x42').parse(frame[:2])
-        frame += self.io.read(2)  # Length
-        length: int = Int16ul.parse(frame[2:])
-        frame += self.io.read(length)  # Rest
-
-        c = DbgMuxFrame.Frame.parse(frame)
+        self._read_at_least(4)  # Magic + Length
+        (buf, pos) = (self._rxbuf, self._rxpos)
+        # Not an assert: this check must not vanish under 'python -O'
+        if buf[pos:pos + 2] != b'\x42\x42':
+            magic = bytes(buf[pos:pos + 2])
+            self._resync()
+            raise DbgMuxFrameError('Unexpected frame magic %r' % magic)
+        length: int = buf[pos + 2] | (buf[pos + 3] << 8)
+        if length < 5:  # TxCount + RxCount + MsgType + FCS
+            self._resync()
+            raise DbgMuxFrameError('Unexpected frame length %d' % length)
+        self._read_at_least(4 + length)  # Rest
+
+        pos = self._rxpos  # may have been reset by _read_at_least()
+        frame = buf[pos:pos + 4 + length]
+        self._rxpos = pos + 4 + length
+        view = memoryview(frame)
+
+        # Parsing the fixed-size header with struct is much faster than
+        # going through the generic DbgMuxFrame.Frame definition
+        (magic, length, tx_count, rx_count, msg_type) = _HDR.unpack_from(frame)
+        try:
+            msg_type = DbgMuxFrame.MsgType(msg_type)
+        except ValueError:
+            pass  # unknown MsgType, keep the raw value
+        c = Container({
+            'Magic': magic,
+            'Length': length,
+            'TxCount': tx_count,
+            'RxCount': rx_count,
+            'MsgType': msg_type,
+            'MsgData': bytes(view[_HDR.size:-2]),
+            'FCS': int.from_bytes(view[-2:], 'little'),
+        })
 
-        log.debug('Rx frame (Ns=%03u, Nr=%03u, fcs=0x%04x) %s %s',
-                  c['TxCount'], c['RxCount'], c['FCS'],
-                  c['MsgType'], c['MsgData'].hex())
+        if log.getLogger().isEnabledFor(log.DEBUG):  # avoid hex() otherwise
+            log.debug('Rx frame (Ns=%03u, Nr=%03u, fcs=0x%04x) %s %s',
+                      c['TxCount'], c['RxCount'], c['FCS'],
+                      c['MsgType'], c['MsgData'].hex())
 
         # Re-calculate and check the FCS
-        fcs = DbgMuxFrame.fcs_func(frame[:-2])
+        fcs = DbgMuxFrame.fcs_func(view[:-2])
         if fcs != c['FCS']:
             log.error('Rx frame (Ns=%03u, Nr=%03u) with bad FCS: '
                       'indicated 0x%04x != calculated 0x%04x',
@@ -86,7 +180,8 @@ class DbgMuxPeer:
             # TODO: NACK this frame?
 
         # Parse the inner message
-        c['Msg'] = DbgMuxFrame.Msg.parse(c['MsgData'], MsgType=c['MsgType'])
+        parser = DbgMuxFrame.MsgParsers.get(msg_type)
+        c['Msg'] = parser(c['MsgData']) if parser else c['MsgData']
 
-        self.rx_count += 1
+        self.rx_count = (self.rx_count + 1) & 0xff
         return c
@@ -17,96 +17,216 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from construct import *
+import array
+import enum
+import sys
 
-import crcmod
+try:
+    # crcmod is optional, and only useful with its C extension
+    import crcmod
+    import crcmod._crcfunext
+except ImportError:
+    crcmod = None
+
+
+def _fcs_table_entry(i: int) -> int:
+    ''' Calculate a single entry of the (reflected) CRC-16/CCITT table '''
+    for _ in range(8):
+        i = (i >> 1) ^ 0x8408 if i & 1 else i >> 1
+    return i
+
+
+# Precomputed at import time, so that the FCS is calculated byte-at-a-time
+_FCS_TABLE = tuple(_fcs_table_entry(i) for i in range(256))
+
+
+def _fcs_calc(data: bytes) -> int:
+    ''' Calculate the FCS (CRC-16/X-25) over the given data bytes '''
+    crc = 0xffff
+    for b in data:
+        crc = (crc >> 8) ^ _FCS_TABLE[(crc ^ b) & 0xff]
+    return crc ^ 0xffff
+
+
+def _fcs_table16_entry(i: int) -> int:
+    ''' Calculate a single entry of the 16-bit word CRC table '''
+    i = (i >> 8) ^ _FCS_TABLE[i & 0xff]
+    return (i >> 8) ^ _FCS_TABLE[i & 0xff]
+
+
+def _fcs_calc_words(data: bytes) -> int:
+    ''' Same as _fcs_calc(), but processing 16-bit words at a time '''
+    crc = 0xffff
+    size = len(data) & ~1
+    words = array.array('H')
+    words.frombytes(memoryview(data)[:size])
+    if sys.byteorder != 'little':
+        words.byteswap()
+    for w in words:
+        crc = _FCS_TABLE16[crc ^ w]
+    if size != len(data):  # odd length
+        crc = (crc >> 8) ^ _FCS_TABLE[(crc ^ data[-1]) & 0xff]
+    return crc ^ 0xffff
+
+
+def _fcs_calc_auto(data: bytes) -> int:
+    ''' Calculate the FCS using the implementation suitable for the length '''
+    if len(data) < 32:  # short frames, like Enquiry or Ack
+        return _fcs_calc(data)
+    return _fcs_calc_words(data)
+
+
+if crcmod is not None:
+    # Native code beats the table lookup above by an order of magnitude
+    fcs_func = crcmod.mkCrcFun(0x11021, rev=True, initCrc=0x0, xorOut=0xffff)
+else:
+    # Processing 16-bit words halves the number of loop iterations, but the
+    # table is 256 times bigger, so it's only built when actually needed
+    _FCS_TABLE16 = tuple(_fcs_table16_entry(i) for i in range(0x10000))
+    fcs_func = _fcs_calc_auto
+
+
+def _pstr(data: bytes, offset: int = 0) -> tuple:
+    ''' Parse an ASCII Pascal string into (string, next offset) '''
+    end = offset + 1 + (data[offset] if offset < len(data) else 0)
+    if end > len(data):  # same as construct's PascalString
+        raise StreamError('truncated Pascal string at offset %d' % offset)
+    return (str(data[offset + 1:end], 'ascii'), end)
+
+
+def parse_ident(data: bytes) -> dict:
+    ''' Parse a MsgType.Ident message (see MsgIdent) '''
+    return {'Magic': bytes(data[:4]), 'Ident': _pstr(data, 4)[0]}
+
+
+def parse_ping_pong(data: bytes) -> str:
+    ''' Parse a MsgType.{Ping,Pong} message (see MsgPingPong) '''
+    return _pstr(data)[0]
+
+
+def parse_dp_announce(data: bytes) -> dict:
+    ''' Parse a MsgType.DPAnnounce message (see MsgDPAnnounce) '''
+    if len(data) < 2:  # same as construct's Int16ul
+        raise StreamError('truncated DPAnnounce message')
+    return {'DPRef': data[0] | (data[1] << 8), 'Name': _pstr(data, 2)[0]}
+
+
+def parse_conn_data(data: bytes) -> tuple:
+    ''' Parse a MsgType.ConnData message into (ConnRef, Data) '''
+    # This is the most frequent message, so do not bother construct
+    if len(data) < 2:  # same as construct's Int16ul
+        raise StreamError('truncated ConnData message')
+    return (data[0] | (data[1] << 8), memoryview(data)[2:])
 
 
 class DbgMuxFrame:
     ''' DebugMux frame definition '''
 
-    # Kudos to Stefan @Sec Zehl for finding the CRC function parameters
-    fcs_func = crcmod.mkCrcFun(0x11021, rev=True, initCrc=0x0, xorOut=0xffff)
+    # Kudos to Stefan @Sec Zehl for finding the CRC function parameters:
+    # poly=0x11021 (reflected), initCrc=0x0000, xorOut=0xffff
+    fcs_func = staticmethod(fcs_func)
+
+    class MsgType(enum.IntEnum):
+        ''' DebugMux message type '''
+        Enquiry             = 0x65  # 'e'
+        Ident               = 0x66  # 'f'
+        Ping                = 0x67  # 'g'
+        Pong                = 0x68  # 'h'
+        DPAnnounce          = 0x69  # 'i'
+        # TODO:             = 0x6a  # 'j'
+        ConnEstablish       = 0x6b  # 'k'
+        ConnEstablished     = 0x6c  # 'l'
+        ConnTerminate       = 0x6d  # 'm'
+        ConnTerminated      = 0x6e  # 'n'
+        ConnData            = 0x6f  # 'o'
+        FlowControl         = 0x70  # 'p'
+        Ack                 = 0x71  # 'q'
 
-    MsgType = Enum(subcon=Int8ul,
-        Enquiry             = 0x65,  # 'e'
-        Ident               = 0x66,  # 'f'
-        Ping                = 0x67,  # 'g'
-        Pong                = 0x68,  # 'h'
-        DPAnnounce          = 0x69,  # 'i'
-        # TODO:             = 0x6a,  # 'j'
-        ConnEstablish       = 0x6b,  # 'k'
-        ConnEstablished     = 0x6c,  # 'l'
-        ConnTerminate       = 0x6d,  # 'm'
-        ConnTerminated      = 0x6e,  # 'n'
-        ConnData            = 0x6f,  # 'o'
-        FlowControl         = 0x70,  # 'p'
-        Ack                 = 0x71,  # 'q'
-    )
+        def __str__(self) -> str:
+            return self.name
 
     Frame = Struct(
         'Magic' / Const(b'\x42\x42'),
-        'Length' / Rebuild(Int16ul, lambda ctx: len(ctx.MsgData) + 5),
+        'Length' / Rebuild(Int16ul, len_(this.MsgData) + 5),
         'TxCount' / Int8ul,
         'RxCount' / Int8ul,
-        'MsgType' / MsgType,
-        'MsgData' / Bytes(lambda ctx: ctx.Length - 5),
+        'MsgType' / Int8ul,  # see MsgType
+        'MsgData' / Bytes(this.Length - 5),
         'FCS' / Int16ul,  # fcs_func() on all preceeding fields
-    )
+    ).compile()
 
     # MsgType.Ident structure
     MsgIdent = Struct(
         'Magic' / Bytes(4),  # TODO
         'Ident' / PascalString(Int8ul, 'ascii'),
-    )
+    ).compile()
 
     # MsgType.{Ping,Pong} structure
-    MsgPingPong = PascalString(Int8ul, 'ascii')
+    MsgPingPong = PascalString(Int8ul, 'ascii').compile()
 
     # MsgType.DPAnnounce structure
     MsgDPAnnounce = Struct(
         'DPRef' / Int16ul,
         'Name' / PascalString(Int8ul, 'ascii'),
-    )
+    ).compile()
 
     # MsgType.ConnEstablish[ed] structure
-    MsgConnEstablish = Struct('DPRef' / Int16ul)
+    MsgConnEstablish = Struct('DPRef' / Int16ul).compile()
     MsgConnEstablished = Struct(
         'DPRef' / Int16ul,
         'ConnRef' / Int16ul,
         'DataBlockLimit' / Int16ul,
-    )
+    ).compile()
 
     # MsgType.ConnTerminate[ed] structure
-    MsgConnTerminate = Struct('ConnRef' / Int16ul)
+    MsgConnTerminate = Struct('ConnRef' / Int16ul).compile()
     MsgConnTerminated = Struct(
         'DPRef' / Int16ul,
         'ConnRef' / Int16ul,
-    )
+    ).compile()
 
     # MsgType.ConnData structure
     MsgConnData = Struct(
         'ConnRef' / Int16ul,
         'Data' / GreedyBytes,
-    )
+    ).compile()
 
     # MsgType.FlowControl structure
     MsgFlowControl = Struct(
         'ConnRef' / Int16ul,
         'DataBlockLimit' / Int8ul,
-	)
+	).compile()
 
-    # Complete message definition
+    # Complete message definition (construct cannot compile IntEnum keys)
     Msg = Switch(this.MsgType, default=GreedyBytes, cases={
-        MsgType.Enquiry             : Const(b''),
-        MsgType.Ident               : MsgIdent,
-        MsgType.Ping                : MsgPingPong,
-        MsgType.Pong                : MsgPingPong,
-        MsgType.DPAnnounce          : MsgDPAnnounce,
-        MsgType.ConnEstablish       : MsgConnEstablish,
-        MsgType.ConnEstablished     : MsgConnEstablished,
-        MsgType.ConnTerminate       : MsgConnTerminate,
-        MsgType.ConnTerminated      : MsgConnTerminated,
-        MsgType.ConnData            : MsgConnData,
-        MsgType.FlowControl         : MsgFlowControl,
-        MsgType.Ack                 : Const(b''),
-    })
+        MsgType.Enquiry.value         : Const(b''),
+        MsgType.Ident.value           : MsgIdent,
+        MsgType.Ping.value            : MsgPingPong,
+        MsgType.Pong.value            : MsgPingPong,
+        MsgType.DPAnnounce.value      : MsgDPAnnounce,
+        MsgType.ConnEstablish.value   : MsgConnEstablish,
+        MsgType.ConnEstablished.value : MsgConnEstablished,
+        MsgType.ConnTerminate.value   : MsgConnTerminate,
+        MsgType.ConnTerminated.value  : MsgConnTerminated,
+        MsgType.ConnData.value        : MsgConnData,
+        MsgType.FlowControl.value     : MsgFlowControl,
+        MsgType.Ack.value             : Const(b''),
+    }).compile()
+
+    # Inner message parsers, indexed by MsgType: unlike Msg, this
+    # does not require evaluating the Switch for every message.
+    # Messages of unknown type shall be returned as-is (GreedyBytes).
+    MsgParsers = {
+        MsgType.Enquiry             : lambda b: b,
+        MsgType.Ident               : parse_ident,
+        MsgType.Ping                : parse_ping_pong,
+        MsgType.Pong                : parse_ping_pong,
+        MsgType.DPAnnounce          : parse_dp_announce,
+        MsgType.ConnEstablish       : MsgConnEstablish.parse,
+        MsgType.ConnEstablished     : MsgConnEstablished.parse,
+        MsgType.ConnTerminate       : MsgConnTerminate.parse,
+        MsgType.ConnTerminated      : MsgConnTerminated.parse,
+        MsgType.ConnData            : parse_conn_data,
+        MsgType.FlowControl         : MsgFlowControl.parse,
+        MsgType.Ack                 : lambda b: b,
+    }
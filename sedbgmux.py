@@ -20,6 +20,8 @@
 
 import logging as log
 import argparse
+import codecs
+import functools
 import cmd2
 import enum
 import sys
@@ -29,6 +31,12 @@ from proto import DbgMuxFrame
 from peer import DbgMuxPeer
 
 
+@functools.lru_cache(maxsize=32)
+def _build_ping(payload: str) -> bytes:
+    ''' Encode a Ping message (the payload is usually the same) '''
+    return DbgMuxFrame.MsgPingPong.build(payload)
+
+
 class SEDbgMuxApp(cmd2.Cmd):
     DESC = 'DebugMux client for [Sony] Ericsson phones and modems'
 
@@ -59,16 +67,24 @@ class SEDbgMuxApp(cmd2.Cmd):
             msg = 'You must be connected to use this command'
             self.disable_category(self.CATEGORY_DBGMUX, msg)
 
+    connect_parser = cmd2.Cmd2ArgumentParser()
+    connect_parser.add_argument('--pipeline', action='store_true',
+                                help='Send the AT commands back-to-back '
+                                     '(may not work with some modems)')
+
+    @cmd2.with_argparser(connect_parser)
     @cmd2.with_category(CATEGORY_CONN)
     def do_connect(self, opts) -> None:
         ''' Connect to the modem and switch it to DebugMux mode '''
-        self.transport.connect()
+        self.transport.connect(pipeline=opts.pipeline)
+        self.peer.reset()
         self.set_connected(True)
 
     @cmd2.with_category(CATEGORY_CONN)
     def do_disconnect(self, opts) -> None:
         ''' Disconnect from the modem '''
         self.transport.disconnect()
+        self.peer.reset()
         self.set_connected(False)
 
     @cmd2.with_category(CATEGORY_CONN)
@@ -97,8 +113,7 @@ class SEDbgMuxApp(cmd2.Cmd):
                          f['Msg']['DPRef'], f['Msg']['Name'])
 
             # No more data in the buffer
-            # FIXME: layer violation!
-            if self.transport._sl.in_waiting == 0:
+            if not self.peer.rx_pending():
                 break
 
         # ACKnowledge reception of the info
@@ -114,7 +129,7 @@ class SEDbgMuxApp(cmd2.Cmd):
     def do_ping(self, opts) -> None:
         ''' Send a Ping to the target, expect Pong '''
         log.info('Tx Ping with payload \'%s\'', opts.payload)
-        self.peer.send(DbgMuxFrame.MsgType.Ping, opts.payload)
+        self.peer.send_data(DbgMuxFrame.MsgType.Ping, _build_ping(opts.payload))
 
         f = self.peer.recv()
         assert f['MsgType'] == DbgMuxFrame.MsgType.Pong
@@ -144,21 +159,33 @@ class SEDbgMuxApp(cmd2.Cmd):
         log.info("Connection established (ConnRef=0x%04x)",
                  f['Msg']['ConnRef'])
 
+        # FIXME: there can be binary data, replace it for now
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = bytearray()
+
         # Read the messages
-        while True:
-            f = self.peer.recv()
+        try:
+            while True:
+                f = self.peer.recv()
 
-            if f['MsgType'] != DbgMuxFrame.MsgType.ConnData:
-                log.warning('Unexpected frame: %s', f)
+                if f['MsgType'] == DbgMuxFrame.MsgType.ConnData:
+                    (_, data) = f['Msg']  # (ConnRef, Data)
+                    pending += data
+                else:
+                    log.warning('Unexpected frame: %s', f)
+
+                # ACKnowledge reception of a frame
                 self.peer.send(DbgMuxFrame.MsgType.Ack)
-                continue
-            try:  # FIXME: there can be binary data
-                self.stdout.write(f['Msg']['Data'].decode())
-            except:  # ... ignore it for now
-                continue
 
-            # ACKnowledge reception of a frame
-            self.peer.send(DbgMuxFrame.MsgType.Ack)
+                # Write the data in bulk, rather than frame by frame
+                if len(pending) > 4096 or not self.peer.rx_pending():
+                    self.stdout.write(decoder.decode(pending))
+                    self.stdout.flush()
+                    pending.clear()
+        finally:
+            # Whatever the reason, do not lose the data already ACKnowledged
+            self.stdout.write(decoder.decode(pending, final=True))
+            self.stdout.flush()
 
 
 ap = argparse.ArgumentParser(prog='sedbgmux', description=SEDbgMuxApp.DESC,
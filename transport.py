@@ -19,58 +19,143 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import logging as log
+import functools
+import selectors
 import serial
 import abc
+import sys
+import os
+import re
+
+from typing import Iterator, List, Tuple, Union
+
+
+# A line of the modem's response, terminated by LF (normally CRLF); trailing
+# whitespace (such as CR of the command echo) is left out of the group, same
+# as readline().rstrip() would do, and the group is None for empty lines
+_LINE_RE = re.compile(rb'([^\n]*\S)?[^\S\n]*\n')
+
+# Kinds of (non-empty) lines received from the modem
+_LINE_RSP = 0  # command echo or response
+_LINE_URC = 1  # event reported by the modem
+
+# Only the Windows backend of pySerial honours inter_byte_timeout in read(),
+# the others would block until all of the requested bytes are received
+_BURST_READ = sys.platform == 'win32'
+_BURST_SIZE = 4096
+_INTER_BYTE_TIMEOUT = 0.02
+
+# pySerial exposes the port's file descriptor everywhere except Windows
+_DIRECT_READ = sys.platform != 'win32'
+
+# Size of the receive buffer (grows only if a single line does not fit)
+_RXBUF_SIZE = 65536
+
+# Pre-encoded AT commands used in every session
+_AT_PROBE = b'AT\r'
+_AT_EDEBUGMUX = b'AT*EDEBUGMUX\r'
 
 
 class TransportIOError(Exception):
     ''' I/O error during read/write operation '''
 
 
+class TransportError(Exception):
+    ''' Unexpected response from the target '''
+
+
 class Transport(abc.ABC):
     ''' Abstract transport layer for DebugMux '''
 
+    __slots__ = ()
+
+    @abc.abstractmethod
     def connect(self, opts: dict) -> None:
         ''' Establish connection to the target and enter DebugMux mode '''
 
+    @abc.abstractmethod
     def disconnect(self) -> None:
         ''' Escape DebugMux mode and terminate connection with the target '''
 
+    @abc.abstractmethod
     def write(self, data: bytes) -> int:
         ''' Write the given data bytes '''
 
+    @abc.abstractmethod
     def read(self, length: int = 0) -> bytes:
         ''' Read the given number of bytes '''
 
+    @abc.abstractmethod
+    def read_exact(self, length: int) -> bytes:
+        ''' Read exactly the given number of bytes, raise on timeout '''
+
+    @abc.abstractmethod
+    def pending(self) -> int:
+        ''' Return the number of bytes available for reading '''
+
 
 class TransportModem(Transport):
     ''' Modem based transport layer for DebugMux '''
 
+    __slots__ = ('modem_port', 'modem_baudrate', 'modem_timeout',
+                 '_sl', '_fd', '_sel', '_rxbuf', '_rxpos', '_rxhead', '_dbg')
+
+    # Pre-encoded AT commands, indexed by command
+    _FRAMES = {
+        'AT'            : _AT_PROBE,
+        'AT*EDEBUGMUX'  : _AT_EDEBUGMUX,
+    }
+
     def __init__(self, opts: dict) -> None:
         self.modem_port = opts.serial_port
         self.modem_baudrate = opts.serial_baudrate
         self.modem_timeout = opts.serial_timeout
 
-    def connect(self) -> None:
+        # Pre-allocated receive buffer: data between _rxpos and _rxhead
+        # is received, but not yet consumed
+        self._rxbuf = bytearray(_RXBUF_SIZE)
+        self._rxpos: int = 0
+        self._rxhead: int = 0
+
+        # Whether to log the modem I/O (checked once, it's on the hot path)
+        self._dbg: bool = log.getLogger().isEnabledFor(log.DEBUG)
+
+    def connect(self, pipeline: bool = False) -> None:
         ''' Establish connection to the target and enter DebugMux mode '''
         self._sl = serial.Serial(port=self.modem_port,
                                  baudrate=self.modem_baudrate,
                                  bytesize=8, parity='N', stopbits=1,
                                  timeout=self.modem_timeout,
+                                 inter_byte_timeout=(_INTER_BYTE_TIMEOUT
+                                                     if _BURST_READ else None),
                                  # xonoff=False,
                                  rtscts=False,
                                  dsrdtr=False)
+        if hasattr(self._sl, 'set_buffer_size'):  # Windows only
+            self._sl.set_buffer_size(rx_size=65536)
+        self._fd = self._sl.fileno() if _DIRECT_READ else None
+        if self._fd is not None:  # registered once, not on every read
+            self._sel = selectors.DefaultSelector()
+            self._sel.register(self._fd, selectors.EVENT_READ)
+
+        if pipeline:  # both commands at once, saves a round-trip
+            self.transceive_many([('AT', 'OK'), ('AT*EDEBUGMUX', 'CONNECT')])
+            return
 
         # Test the modem
-        self.transceive('AT', 'OK')
+        self._tx_at()
         # Enable DebugMux mode
-        self.transceive('AT*EDEBUGMUX', 'CONNECT')
+        self._tx_edebugmux()
 
     def disconnect(self) -> None:
         ''' Escape DebugMux mode and terminate connection with the target '''
         # TODO: escape DebugMux mode
+        if self._fd is not None:
+            self._sel.close()
+            del self._sel
         self._sl.close()
-        del self._sl
+        self._rxpos = self._rxhead = 0
+        del self._sl, self._fd
 
     def write(self, data: bytes) -> int:
         ''' Write the given data bytes '''
@@ -81,38 +166,194 @@ class TransportModem(Transport):
 
     def read(self, length: int = 0) -> bytes:
         ''' Read the given number of bytes '''
+        (pos, head) = (self._rxpos, self._rxhead)
+        if head - pos >= length:  # already buffered
+            self._rxpos = pos + length
+            return bytes(self._rxbuf[pos:pos + length])
+        data = bytearray(self._rxbuf[pos:head])
+        self._rxpos = self._rxhead = 0
         try:
-            return self._sl.read(length)
+            while len(data) < length:
+                # read() may return early due to inter_byte_timeout
+                chunk: bytes = self._sl.read(length - len(data))
+                if not chunk:
+                    break  # timeout
+                data += chunk
         except Exception as e:
             raise TransportIOError('Failed to read() data') from e
+        return bytes(data)
+
+    def read_exact(self, length: int) -> bytes:
+        ''' Read exactly the given number of bytes, raise on timeout '''
+        if self._fd is None:
+            data: bytes = self.read(length)
+            if len(data) != length:
+                self._unread(data)  # not lost, retried by the next read
+                raise TransportIOError('Timeout reading %d bytes' % length)
+            return data
+        (pos, head) = (self._rxpos, self._rxhead)
+        if head - pos >= length:  # already buffered
+            self._rxpos = pos + length
+            return bytes(self._rxbuf[pos:pos + length])
+        # Bypass pySerial's read(), which is a Python loop with a Timeout
+        # object on each call: wait for the fd and read it directly
+        buf = bytearray(length)
+        offset: int = head - pos
+        buf[:offset] = self._rxbuf[pos:head]
+        self._rxpos = self._rxhead = 0
+        with memoryview(buf) as mv:
+            try:
+                while offset < length:
+                    offset += self._read_fd(mv[offset:])
+            except TransportIOError:
+                self._unread(mv[:offset])  # not lost, retried by the next read
+                raise
+        return bytes(buf)
+
+    def pending(self) -> int:
+        ''' Return the number of bytes available for reading '''
+        try:
+            return self._sl.in_waiting + self._rxhead - self._rxpos
+        except Exception as e:
+            raise TransportIOError('Failed to get pending() data') from e
+
+    def _unread(self, data: bytes) -> None:
+        ''' Put the given data back into the (consumed) receive buffer '''
+        self._rxbuf[:len(data)] = data  # may grow the buffer
+        (self._rxpos, self._rxhead) = (0, len(data))
+
+    def _compact(self) -> None:
+        ''' Move the unconsumed data to the beginning of the buffer '''
+        (pos, head) = (self._rxpos, self._rxhead)
+        if pos > 0:
+            self._rxbuf[:head - pos] = self._rxbuf[pos:head]
+        elif head == len(self._rxbuf):  # a single line does not fit
+            self._rxbuf += bytes(len(self._rxbuf))
+        self._rxpos = 0
+        self._rxhead = head - pos
+
+    def _read_fd(self, mv: memoryview) -> int:
+        ''' Wait for data on the port, read as much as fits into mv '''
+        while True:
+            try:
+                ready = self._sel.select(self.modem_timeout)
+                n: int = os.readv(self._fd, [mv]) if ready else 0
+            except BlockingIOError:
+                continue  # spurious wakeup
+            except Exception as e:
+                raise TransportIOError('Failed to read() data') from e
+            if not ready:
+                raise TransportIOError('Timeout reading data')
+            if n == 0:  # readable, but EOF: same as pySerial reports it
+                raise TransportIOError('device disconnected')
+            return n
+
+    def _fill(self) -> None:
+        ''' Read all available data (at least one byte) into the buffer '''
+        if len(self._rxbuf) - self._rxhead < _BURST_SIZE:
+            self._compact()
+        head = self._rxhead
+        with memoryview(self._rxbuf) as mv:
+            if self._fd is None:  # returns as soon as the modem pauses
+                n: int = self._sl.readinto(mv[head:head + _BURST_SIZE])
+            else:  # straight from the kernel, no intermediate bytes object
+                n = self._read_fd(mv[head:])
+        self._rxhead = head + n
+
+    def _at_frame(self, cmd: Union[str, bytes]) -> bytes:
+        ''' Encode the given AT command '''
+        data: bytes = self._FRAMES.get(cmd)
+        if data is None:
+            data = (cmd.encode() if isinstance(cmd, str) else cmd) + b'\r'
+        return data
 
-    def send_at_cmd(self, cmd: str, handle_echo: bool = True) -> None:
+    def send_at_cmd(self, cmd: Union[str, bytes], handle_echo: bool = True) -> None:
         ''' Send an AT command to the modem '''
-        data: bytes = cmd.encode() + b'\r'
-        log.debug('MODEM <- %s', str(data))
+        # Keep everything as bytes, so that echo lines need no decoding
+        self._send_frame(self._at_frame(cmd), handle_echo)
+
+    def _send_frame(self, data: bytes, handle_echo: bool = True) -> None:
+        ''' Send an already encoded AT command to the modem '''
+        if self._dbg:
+            log.debug('MODEM <- %s', data)
         self.write(data)
-        while handle_echo:
-            rdata: bytes = self._sl.readline()
-            line: str = rdata.rstrip().decode()
-            if not line:
+        if handle_echo:
+            self._read_at_echo(data[:-1])  # strip b'\r'
+
+    def _iter_lines(self) -> Iterator[Tuple[int, bytes]]:
+        ''' Yield (kind, line) for every non-empty line from the modem '''
+        # Looked up once, rather than on every line
+        match = _LINE_RE.match  # anchored, so that no line is skipped
+        buf: bytearray = self._rxbuf  # only ever resized in place
+        fill = self._fill
+        while True:
+            m = match(buf, self._rxpos, self._rxhead)
+            if m is None:
+                fill()
+                continue
+            self._rxpos = m.end()  # consumed
+            line: bytes = m.group(1)
+            if line is None:
                 continue  # Ignore empty lines
-            if line == cmd:
+            yield (_LINE_URC if line[0] in b'+*' else _LINE_RSP, line)
+
+    def _read_at_echo(self, cmd_bytes: bytes) -> None:
+        ''' Consume the echo of an AT command sent to the modem '''
+        dbg: bool = self._dbg
+        for (_, line) in self._iter_lines():
+            if line == cmd_bytes:
                 break
-            log.debug('MODEM -> %s', str(rdata))
+            if dbg:
+                log.debug('MODEM -> %s', line)
 
     def read_at_rsp(self) -> str:
         ''' Read an AT command response from the modem '''
-        while True:
-            rdata: bytes = self._sl.readline()
-            line: str = rdata.rstrip().decode()
-            if not line:
-                continue  # Ignore empty lines
-            log.debug('MODEM -> %s', str(rdata))
-            if line.startswith(('+', '*')):
+        # AT responses are 7-bit ASCII, but do not choke on junk
+        return self._read_at_rsp().decode('ascii', errors='replace')
+
+    def _read_at_rsp(self) -> bytes:
+        ''' Read an AT command response from the modem (as bytes) '''
+        dbg: bool = self._dbg
+        for (kind, line) in self._iter_lines():
+            if dbg:
+                log.debug('MODEM -> %s', line)
+            if kind == _LINE_URC:
                 continue  # Ignore events reported by the modem
             return line
 
-    def transceive(self, cmd: str, exp: str) -> None:
+    def _expect_at_rsp(self, exp: bytes) -> None:
+        ''' Read an AT command response, make sure it's the expected one '''
+        # Not an assert: this check must not vanish under 'python -O'
+        rsp: bytes = self._read_at_rsp()
+        if rsp != exp:
+            raise TransportError('Unexpected response %r (expected %r)' % (rsp, exp))
+
+    def transceive(self, cmd: Union[str, bytes], exp: Union[str, bytes]) -> None:
         self.send_at_cmd(cmd)
-        rsp = self.read_at_rsp()
-        assert rsp == exp
+        self._expect_at_rsp(exp.encode() if isinstance(exp, str) else exp)
+
+    def _transceive_frame(self, frame: bytes, exp: bytes) -> None:
+        ''' Same as transceive(), but for an already encoded command '''
+        self._send_frame(frame)
+        self._expect_at_rsp(exp)
+
+    # Specialized for the commands sent in every session
+    _tx_at = functools.partialmethod(_transceive_frame, _AT_PROBE, b'OK')
+    _tx_edebugmux = functools.partialmethod(_transceive_frame,
+                                            _AT_EDEBUGMUX, b'CONNECT')
+
+    def transceive_many(self, pairs: List[Tuple[Union[str, bytes],
+                                                Union[str, bytes]]]) -> None:
+        ''' Send several AT commands at once, then check their responses '''
+        # The modem processes the commands one by one, so the echo and the
+        # response of each of them can be read in order.  The round-trips
+        # are overlapping this way, but note that some modems may need a
+        # delay between commands.
+        frames: List[bytes] = [self._at_frame(cmd) for (cmd, _) in pairs]
+        data: bytes = b''.join(frames)
+        if self._dbg:
+            log.debug('MODEM <- %s', data)
+        self.write(data)
+        for (frame, (_, exp)) in zip(frames, pairs):
+            self._read_at_echo(frame[:-1])  # strip b'\r'
+            self._expect_at_rsp(exp.encode() if isinstance(exp, str) else exp)